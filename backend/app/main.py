@@ -1,11 +1,18 @@
-import json
-import uuid
+import asyncio
+import logging
+import os
+import secrets
+from contextlib import asynccontextmanager
 
+import orjson
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
+from redis.asyncio import Redis
+
+from .utils.auth import SimpleAuth
 
 # Load environment variables from .env file
 load_dotenv()
@@ -15,8 +22,36 @@ from .services.transcription_service import TranscriptionService
 from .websockets.chat_handler import ChatHandler
 from .websockets.room_manager import RoomManager
 
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
+logger = logging.getLogger(__name__)
+
+# Messages handled per dispatcher wake-up, and the most a client may queue
+WS_BATCH_SIZE = 32
+WS_QUEUE_SIZE = 256
+
+# Connection confirmation with user_type spliced in verbatim (it is validated
+# against a fixed set) and class_id spliced in as an encoded JSON string
+_CONFIRMATION_TEMPLATE = (
+    '{"type":"connection_confirmed","user_type":"%s","class_id":%s}'
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Connect shared storage on startup and release it on shutdown"""
+    redis_url = os.getenv("REDIS_URL")
+    app.state.redis = Redis.from_url(redis_url) if redis_url else None
+    transcription_service.redis = app.state.redis
+    yield
+    if app.state.redis:
+        await app.state.redis.aclose()
+
+
 app = FastAPI(
-    title="Instructify API", description="EdTech Platform with AI-powered features"
+    title="Instructify API",
+    description="EdTech Platform with AI-powered features",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 
 # CORS middleware for Next.js frontend
@@ -58,7 +93,7 @@ async def health():
 @app.post("/api/classroom/create")
 async def create_classroom(classroom_data: ClassroomCreate):
     """Create a new classroom and return classroom ID"""
-    class_id = str(uuid.uuid4())[:8]  # Short ID for easy sharing
+    class_id = secrets.token_hex(4)  # Short ID for easy sharing
     await room_manager.create_room(class_id, classroom_data.teacher_name)
     return {"class_id": class_id, "teacher_name": classroom_data.teacher_name}
 
@@ -76,14 +111,16 @@ async def get_classroom(class_id: str):
 @app.post("/api/transcription/{class_id}/add")
 async def add_transcript_chunk(class_id: str, chunk: TranscriptChunk):
     """Add a chunk of transcribed text to the class"""
-    transcription_service.add_transcript_chunk(class_id, chunk.text, chunk.timestamp)
+    await transcription_service.add_transcript_chunk(
+        class_id, chunk.text, chunk.timestamp
+    )
     return {"status": "success", "message": "Transcript chunk added"}
 
 
 @app.get("/api/transcription/{class_id}")
 async def get_transcript(class_id: str):
     """Get the full transcript for a class"""
-    transcript = transcription_service.get_transcript(class_id)
+    transcript = await transcription_service.get_transcript(class_id)
     return {"transcript": transcript}
 
 
@@ -103,13 +140,50 @@ async def download_notes(class_id: str):
     if not notes:
         raise HTTPException(status_code=404, detail="No notes available")
     
-    formatted_notes = transcription_service.export_notes(class_id, notes)
-    return PlainTextResponse(
-        formatted_notes,
+    return StreamingResponse(
+        transcription_service.export_notes(class_id, notes),
+        media_type="text/plain; charset=utf-8",
         headers={"Content-Disposition": f"attachment; filename=class_notes_{class_id}.txt"}
     )
 
 
+async def _dispatch_messages(
+    class_id: str, websocket: WebSocket, queue: asyncio.Queue
+) -> None:
+    """Handle queued messages in order, draining bursts in batches"""
+    try:
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < WS_BATCH_SIZE and not queue.empty():
+                batch.append(queue.get_nowait())
+
+            for message in batch:
+                if message is None:  # Client disconnected
+                    return
+                await chat_handler.handle_message(class_id, websocket, message)
+    finally:
+        # Unblock a receiver waiting on a full queue if handling stops early
+        while not queue.empty():
+            queue.get_nowait()
+
+
+async def _receive_messages(
+    websocket: WebSocket, queue: asyncio.Queue, user_name: str, user_type: str
+) -> None:
+    """Queue incoming messages until the client disconnects"""
+    async for data in websocket.iter_text():
+        message = orjson.loads(data)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Received WebSocket message: %s from %s (%s)",
+                message.get("type"),
+                user_name,
+                user_type,
+            )
+
+        await queue.put(message)
+
+
 @app.websocket("/ws/classroom/{class_id}")
 async def websocket_endpoint(websocket: WebSocket, class_id: str):
     """Main WebSocket endpoint for classroom communication"""
@@ -118,38 +192,56 @@ async def websocket_endpoint(websocket: WebSocket, class_id: str):
     try:
         # Wait for initial message to determine user type (teacher/student)
         data = await websocket.receive_text()
-        message = json.loads(data)
+        message = orjson.loads(data)
 
         user_type = message.get("user_type")  # "teacher" or "student"
         user_name = message.get("user_name", "Anonymous")
 
+        if not SimpleAuth.validate_user_type(user_type):
+            await websocket.close(code=1008)
+            return
+
         # Add user to room
         await room_manager.add_user_to_room(class_id, websocket, user_type, user_name)
 
         # Send confirmation
         await websocket.send_text(
-            json.dumps(
-                {
-                    "type": "connection_confirmed",
-                    "user_type": user_type,
-                    "class_id": class_id,
-                }
-            )
+            _CONFIRMATION_TEMPLATE % (user_type, orjson.dumps(class_id).decode())
         )
 
-        # Handle incoming messages
-        while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
-            
-            print(f"📨 Received WebSocket message: {message.get('type')} from {user_name} ({user_type})")
+        # Keep receiving while a dispatcher handles messages in order, so a
+        # burst that arrives during a slow AI call is drained in one pass
+        queue: asyncio.Queue = asyncio.Queue(maxsize=WS_QUEUE_SIZE)
+        dispatcher = asyncio.create_task(
+            _dispatch_messages(class_id, websocket, queue)
+        )
+        receiver = asyncio.create_task(
+            _receive_messages(websocket, queue, user_name, user_type)
+        )
+        try:
+            # Whichever stops first decides: a failed handler surfaces here
+            # right away instead of when the client next sends something
+            await asyncio.wait(
+                {receiver, dispatcher}, return_when=asyncio.FIRST_COMPLETED
+            )
+            if dispatcher.done():
+                dispatcher.result()  # Raises if a handler failed
+
+            # iter_text ends quietly on disconnect; finish what was queued
+            receiver.result()
+            if not dispatcher.done():
+                await queue.put(None)
+            await dispatcher
+        finally:
+            receiver.cancel()
+            dispatcher.cancel()
 
-            await chat_handler.handle_message(class_id, websocket, message)
+        await room_manager.remove_user_from_room(class_id, websocket)
 
     except WebSocketDisconnect:
         await room_manager.remove_user_from_room(class_id, websocket)
     except Exception as e:
-        print(f"WebSocket error: {e}")
+        logger.error("WebSocket error: %s", e)
         await websocket.close()
 
 
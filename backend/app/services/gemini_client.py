@@ -1,9 +1,131 @@
+import asyncio
+import functools
+import hashlib
 import json
+import logging
 import os
 import re
-from typing import Any, Dict, Optional
+import time
+from typing import Any, Dict, Optional, Tuple
 
 import google.generativeai as genai
+from cachetools import TTLCache
+from typing_extensions import TypedDict
+
+logger = logging.getLogger(__name__)
+
+
+class _FilterVerdict(TypedDict):
+    is_safe: bool
+    confidence: float
+    reason: str
+    category: str
+
+
+class _DoubtClassification(TypedDict):
+    is_genuine_doubt: bool
+    confidence: float
+    reason: str
+    category: str
+
+
+# Common classroom replies that are safe without asking the model
+_SAFE_SHORT = frozenset(
+    {
+        "ok", "okay", "yes", "yeah", "no", "thanks", "thank you", "thx", "hi",
+        "hello", "hey", "bye", "got it", "understood", "sure", "done", "great",
+        "cool", "nice", "good morning", "good afternoon", "sorry", "same",
+    }
+)
+
+# Messages worth classifying as doubts. Only clear non-questions skip the
+# model, so question words match anywhere ("sir what is a limit") and an
+# auxiliary opener may follow one polite word ("ma'am could you...")
+_DOUBT_HINT = re.compile(
+    r"\?"
+    r"|\b(what|why|how|when|where|which|who|explain|question|mean|repeat"
+    r"|go over)\b"
+    r"|^([\w'’]+[\s,]+)?(can|could|would|should|is|are|do|does|did|will)\b"
+    r"|\b(confus|understand|doubt|unclear|stuck|help|lost|not sure)"
+    r"|\b(don['’]?t|do not|didn['’]?t|did not) (get|know)\b"
+)
+
+# Structured output: Gemini returns a JSON object matching the schema. The SDK
+# converts the schemas through pydantic, which rejects typing.TypedDict before
+# Python 3.12
+_FILTER_CONFIG = genai.GenerationConfig(
+    response_mime_type="application/json", response_schema=_FilterVerdict
+)
+_DOUBT_CONFIG = genai.GenerationConfig(
+    response_mime_type="application/json", response_schema=_DoubtClassification
+)
+
+_FILTER_PROMPT = """Analyze this message for harmful, inappropriate, unsafe, or educational inappropriateness.
+
+Message: "{content}"
+
+You are a content filter for an educational platform. Be VERY STRICT about safety.
+
+Mark as UNSAFE if the message contains:
+- ANY violence, threats, or harmful intentions (even subtle ones)
+- Weapons, bombs, explosives, or violence references
+- Inappropriate sexual content or references
+- Hate speech, harassment, or bullying
+- Illegal activities or instructions
+- Personal attacks or mean behavior
+- Spam, nonsense, or disruptive content
+- Off-topic non-educational content in a classroom setting
+
+Mark as SAFE ONLY if it's:
+- Legitimate educational questions or discussions
+- Appropriate classroom communication
+- Polite requests or conversations
+- Academic content related queries
+
+Give a confidence from 0.0 to 1.0, a brief reason, and one category of:
+safe|violence|threats|inappropriate|sexual|hate_speech|illegal|spam|off_topic
+
+Be extra cautious - err on the side of blocking questionable content."""
+
+_DOUBT_PROMPT = """Analyze this student message to determine if it's a genuine academic doubt that should be forwarded to the teacher.
+
+Context from recent class discussion:
+{context}
+
+Student message: "{message}"
+
+A message should be classified as a GENUINE DOUBT if it's:
+- A specific academic question about the current subject/lesson
+- Request for clarification on course material being taught
+- Question about assignments, homework, or course logistics
+- Confusion about concepts being discussed in class
+
+Do NOT classify as genuine doubt if it's:
+- General knowledge questions unrelated to current lesson
+- Personal queries meant for the AI assistant
+- Off-topic discussions or casual conversation
+- Spam, inappropriate, or disruptive content
+- Questions already answered in the current context
+
+Give a confidence from 0.0 to 1.0, a brief reason, and one category of:
+academic_question|personal_ai_query|off_topic|spam|inappropriate"""
+
+_ANSWER_PROMPT = """You are an AI teaching assistant for an educational platform. Answer the student's question helpfully and educationally.
+
+Current class context:
+{lecture_context}
+
+Student question: {query}
+
+Guidelines:
+- Provide clear, educational responses appropriate for a classroom setting
+- If the question relates to the lecture context, reference it in your answer
+- If the question is outside the current lesson scope, provide general educational guidance and suggest asking the teacher for more specific help
+- Keep responses concise but informative (2-4 sentences)
+- Maintain an encouraging, supportive tone
+- If you cannot answer the question appropriately, redirect to the teacher
+
+IMPORTANT: Only provide educational responses. Do not engage with inappropriate requests."""
 
 
 class GeminiClient:
@@ -16,6 +138,14 @@ class GeminiClient:
         
         genai.configure(api_key=self.api_key)
         self.model = genai.GenerativeModel("gemini-2.0-flash-exp")
+
+        # Filter verdicts keyed by a digest of the normalized content
+        self._filter_cache: TTLCache = TTLCache(maxsize=4096, ttl=3600)
+        # Doubt classifications and answers keyed by message and context digests
+        self._doubt_cache: TTLCache = TTLCache(maxsize=4096, ttl=3600)
+        self._answer_cache: TTLCache = TTLCache(maxsize=4096, ttl=3600)
+        # Last availability check as (monotonic time, result)
+        self._availability: Tuple[float, bool] = (0.0, False)
         
         # Harmful keywords for first-layer filtering
         self.harmful_keywords = {
@@ -26,20 +156,48 @@ class GeminiClient:
             'sexual': ['sex', 'sexual', 'nude', 'porn', 'inappropriate touching']
         }
 
-    async def _keyword_filter(self, content: str) -> Dict[str, Any]:
+        # Single-word keywords are matched against message tokens with a set
+        # lookup, which also avoids hits inside unrelated words; multi-word
+        # phrases keep a substring scan
+        self._keyword_categories = {
+            keyword: category
+            for category, keywords in self.harmful_keywords.items()
+            for keyword in keywords
+        }
+        self._keyword_set = frozenset(
+            keyword for keyword in self._keyword_categories if " " not in keyword
+        )
+        self._keyword_phrases = tuple(
+            keyword for keyword in self._keyword_categories if " " in keyword
+        )
+        self._tokenizer = re.compile(r"[a-z']+")
+
+    def _keyword_filter(self, content: str) -> Dict[str, Any]:
         """First layer: Quick keyword-based filtering"""
         content_lower = content.lower()
-        
-        for category, keywords in self.harmful_keywords.items():
-            for keyword in keywords:
-                if keyword in content_lower:
-                    return {
-                        "is_safe": False,
-                        "confidence": 0.9,
-                        "reason": f"Contains harmful keyword: '{keyword}' (category: {category})",
-                        "category": category,
-                        "filter_type": "keyword"
-                    }
+        keyword = next(
+            (
+                token
+                for token in self._tokenizer.findall(content_lower)
+                if token in self._keyword_set
+            ),
+            None,
+        )
+        if keyword is None:
+            keyword = next(
+                (phrase for phrase in self._keyword_phrases if phrase in content_lower),
+                None,
+            )
+
+        if keyword is not None:
+            category = self._keyword_categories[keyword]
+            return {
+                "is_safe": False,
+                "confidence": 0.9,
+                "reason": f"Contains harmful keyword: '{keyword}' (category: {category})",
+                "category": category,
+                "filter_type": "keyword"
+            }
         
         return {
             "is_safe": True,
@@ -49,66 +207,64 @@ class GeminiClient:
             "filter_type": "keyword"
         }
 
+    @staticmethod
+    def _cache_key(text: str) -> bytes:
+        """Digest of normalized text used as a cache key"""
+        return hashlib.blake2b(text.strip().lower().encode(), digest_size=16).digest()
+
     async def filter_content(self, content: str) -> Dict[str, Any]:
         """Dual-layer content filtering: keywords + AI analysis"""
+        key = self._cache_key(content)
+        cached = self._filter_cache.get(key)
+        if cached is not None:
+            return cached
         
         # Layer 1: Quick keyword filtering
-        keyword_result = await self._keyword_filter(content)
+        keyword_result = self._keyword_filter(content)
         if not keyword_result["is_safe"]:
-            print(f"🚫 BLOCKED by keyword filter: {content}")
+            logger.info("Blocked by keyword filter: %s", content)
+            self._filter_cache[key] = keyword_result
             return keyword_result
 
-        # Layer 2: AI-powered content analysis
-        try:
-            prompt = f"""Analyze this message for harmful, inappropriate, unsafe, or educational inappropriateness.
-
-Message: "{content}"
-
-You are a content filter for an educational platform. Be VERY STRICT about safety.
-
-Mark as UNSAFE if the message contains:
-- ANY violence, threats, or harmful intentions (even subtle ones)
-- Weapons, bombs, explosives, or violence references
-- Inappropriate sexual content or references
-- Hate speech, harassment, or bullying
-- Illegal activities or instructions
-- Personal attacks or mean behavior
-- Spam, nonsense, or disruptive content
-- Off-topic non-educational content in a classroom setting
+        # Very short messages and stock replies don't need the AI check
+        normalized = content.strip().lower().rstrip(".!")
+        if len(normalized) <= 3 or normalized in _SAFE_SHORT:
+            return {
+                "is_safe": True,
+                "confidence": 0.9,
+                "reason": "Short common message",
+                "category": "safe",
+                "filter_type": "local"
+            }
 
-Mark as SAFE ONLY if it's:
-- Legitimate educational questions or discussions
-- Appropriate classroom communication
-- Polite requests or conversations
-- Academic content related queries
+        # Layer 2: AI-powered content analysis
+        result = await self._ai_safety_check(content)
+        self._remember_verdict(key, result)
+        return result
 
-Respond in JSON format:
-{{
-    "is_safe": true/false,
-    "confidence": 0.0-1.0,
-    "reason": "brief explanation",
-    "category": "safe|violence|threats|inappropriate|sexual|hate_speech|illegal|spam|off_topic"
-}}
+    def _remember_verdict(self, key: bytes, result: Dict[str, Any]) -> None:
+        """Cache an AI filter verdict unless the analysis itself failed"""
+        # Failed analyses block for safety but should be retried next time
+        if result.get("filter_type") != "ai_error":
+            self._filter_cache[key] = result
 
-Be extra cautious - err on the side of blocking questionable content."""
+    async def _ai_safety_check(self, content: str) -> Dict[str, Any]:
+        """Second layer: AI-powered content analysis"""
+        try:
+            prompt = _FILTER_PROMPT.format(content=content)
 
-            response = self.model.generate_content(prompt)
-            response_text = response.text.strip()
+            response = await self.model.generate_content_async(
+                prompt, generation_config=_FILTER_CONFIG
+            )
+            result = json.loads(response.text)
+            result["filter_type"] = "ai"
             
-            # Extract JSON from response
-            json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-            if json_match:
-                try:
-                    result = json.loads(json_match.group())
-                    result["filter_type"] = "ai"
-                    
-                    if not result.get("is_safe", False):
-                        print(f"🚫 BLOCKED by AI filter: {content} - {result.get('reason')}")
-                    
-                    return result
-                except json.JSONDecodeError:
-                    pass
+            if not result.get("is_safe", False):
+                logger.info("Blocked by AI filter: %s - %s", content, result.get("reason"))
             
+            return result
+
+        except json.JSONDecodeError:
             # Fallback - assume unsafe if can't parse
             return {
                 "is_safe": False,
@@ -117,9 +273,9 @@ Be extra cautious - err on the side of blocking questionable content."""
                 "category": "unknown",
                 "filter_type": "ai_error"
             }
-            
+
         except Exception as e:
-            print(f"Error in AI content filtering: {e}")
+            logger.error("Error in AI content filtering: %s", e)
             # Fail closed - block content if AI analysis fails
             return {
                 "is_safe": False,
@@ -131,46 +287,33 @@ Be extra cautious - err on the side of blocking questionable content."""
 
     async def classify_doubt(self, message: str, context: str = "") -> Dict[str, Any]:
         """Classify if a message is a genuine academic doubt for the teacher"""
-        try:
-            prompt = f"""Analyze this student message to determine if it's a genuine academic doubt that should be forwarded to the teacher.
+        key = self._cache_key(message) + self._cache_key(context)
+        cached = self._doubt_cache.get(key)
+        if cached is not None:
+            return cached
 
-Context from recent class discussion:
-{context if context else "No recent context available"}
-
-Student message: "{message}"
-
-A message should be classified as a GENUINE DOUBT if it's:
-- A specific academic question about the current subject/lesson
-- Request for clarification on course material being taught
-- Question about assignments, homework, or course logistics
-- Confusion about concepts being discussed in class
+        if not _DOUBT_HINT.search(message.strip().lower()):
+            return {
+                "is_genuine_doubt": False,
+                "confidence": 0.7,
+                "reason": "Not phrased as a question",
+                "category": "off_topic"
+            }
 
-Do NOT classify as genuine doubt if it's:
-- General knowledge questions unrelated to current lesson
-- Personal queries meant for the AI assistant
-- Off-topic discussions or casual conversation
-- Spam, inappropriate, or disruptive content
-- Questions already answered in the current context
+        try:
+            prompt = _DOUBT_PROMPT.format(
+                context=context or "No recent context available",
+                message=message,
+            )
 
-Respond in JSON format:
-{{
-    "is_genuine_doubt": true/false,
-    "confidence": 0.0-1.0,
-    "reason": "brief explanation",
-    "category": "academic_question|personal_ai_query|off_topic|spam|inappropriate"
-}}"""
+            response = await self.model.generate_content_async(
+                prompt, generation_config=_DOUBT_CONFIG
+            )
+            result = json.loads(response.text)
+            self._doubt_cache[key] = result
+            return result
 
-            response = self.model.generate_content(prompt)
-            response_text = response.text.strip()
-            
-            # Extract JSON from response
-            json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-            if json_match:
-                try:
-                    return json.loads(json_match.group())
-                except json.JSONDecodeError:
-                    pass
-            
+        except json.JSONDecodeError:
             # Fallback
             return {
                 "is_genuine_doubt": False,
@@ -178,9 +321,9 @@ Respond in JSON format:
                 "reason": "Could not analyze message",
                 "category": "unknown"
             }
-            
+
         except Exception as e:
-            print(f"Error classifying doubt: {e}")
+            logger.error("Error classifying doubt: %s", e)
             return {
                 "is_genuine_doubt": False,
                 "confidence": 0.0,
@@ -191,52 +334,80 @@ Respond in JSON format:
     async def answer_student_query(self, query: str, lecture_context: str = "") -> Optional[str]:
         """Answer student query with safety filtering and educational focus"""
         
-        # First, filter the query for harmful content
-        filter_result = await self.filter_content(query)
-        
-        if not filter_result.get("is_safe", False):
-            print(f"🚫 Blocked harmful AI query: {query} - {filter_result.get('reason')}")
-            return "I cannot respond to that message. Please keep our conversation educational and appropriate. If you have academic questions, I'm here to help with those."
-        
-        try:
-            # Content is safe, proceed with educational response
-            prompt = f"""You are an AI teaching assistant for an educational platform. Answer the student's question helpfully and educationally.
+        refusal = "I cannot respond to that message. Please keep our conversation educational and appropriate. If you have academic questions, I'm here to help with those."
 
-Current class context:
-{lecture_context if lecture_context else "No specific lecture context available"}
+        # First, reuse an earlier verdict or run the quick keyword filter
+        key = self._cache_key(query)
+        answer_key = key + self._cache_key(lecture_context)
+        cached_answer = self._answer_cache.get(answer_key)
+        if cached_answer is not None:
+            return cached_answer
 
-Student question: {query}
+        filter_result = self._filter_cache.get(key)
+        if filter_result is None:
+            filter_result = self._keyword_filter(query)
+            if not filter_result["is_safe"]:
+                self._filter_cache[key] = filter_result
 
-Guidelines:
-- Provide clear, educational responses appropriate for a classroom setting
-- If the question relates to the lecture context, reference it in your answer
-- If the question is outside the current lesson scope, provide general educational guidance and suggest asking the teacher for more specific help
-- Keep responses concise but informative (2-4 sentences)
-- Maintain an encouraging, supportive tone
-- If you cannot answer the question appropriately, redirect to the teacher
+        if not filter_result.get("is_safe", False):
+            logger.info("Blocked harmful AI query: %s - %s", query, filter_result.get("reason"))
+            return refusal
+        
+        try:
+            prompt = _ANSWER_PROMPT.format(
+                lecture_context=lecture_context or "No specific lecture context available",
+                query=query,
+            )
+            answer_task = asyncio.create_task(self.model.generate_content_async(prompt))
 
-IMPORTANT: Only provide educational responses. Do not engage with inappropriate requests."""
+            # A keyword pass still needs the AI safety check; run it while the
+            # answer is generated and only return the answer once it passes
+            if filter_result["filter_type"] == "keyword":
+                filter_result = await self._ai_safety_check(query)
+                self._remember_verdict(key, filter_result)
+                if not filter_result.get("is_safe", False):
+                    answer_task.cancel()
+                    logger.info("Blocked harmful AI query: %s - %s", query, filter_result.get("reason"))
+                    return refusal
 
-            response = self.model.generate_content(prompt)
+            response = await answer_task
             response_text = response.text.strip()
             
             # Filter the AI's response as well
             response_filter = await self.filter_content(response_text)
             if not response_filter.get("is_safe", False):
-                print(f"🚫 Blocked AI response: {response_text} - {response_filter.get('reason')}")
+                logger.info(
+                    "Blocked AI response: %s - %s", response_text, response_filter.get("reason")
+                )
                 return "I cannot provide that information. Please ask an educational question and I'll be happy to help."
             
+            self._answer_cache[answer_key] = response_text
             return response_text
             
         except Exception as e:
-            print(f"Error generating AI response: {e}")
+            logger.error("Error generating AI response: %s", e)
             return "I'm experiencing technical difficulties. Please try asking your question again or reach out to your teacher directly."
 
     async def is_available(self) -> bool:
-        """Check if Gemini API is available"""
+        """Check if Gemini API is available, reusing results for 30 seconds"""
+        checked_at, available = self._availability
+        now = time.monotonic()
+        if checked_at and now - checked_at < 30.0:
+            return available
+
         try:
-            # Simple test to verify API connectivity
-            test_response = self.model.generate_content("Test connectivity. Respond with 'OK'.")
-            return "OK" in test_response.text.upper()
+            # Model metadata lookup verifies connectivity without spending
+            # generation quota
+            await asyncio.to_thread(genai.get_model, self.model.model_name)
+            available = True
         except Exception:
-            return False
\ No newline at end of file
+            available = False
+
+        self._availability = (now, available)
+        return available
+
+
+@functools.lru_cache(maxsize=None)
+def get_gemini_client() -> GeminiClient:
+    """Shared GeminiClient, so one SDK transport and set of caches serve the process"""
+    return GeminiClient()
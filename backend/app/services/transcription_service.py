@@ -1,66 +1,142 @@
-import json
+import logging
 import os
+from collections import deque
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional, Tuple
 
-from .gemini_client import GeminiClient
+import msgpack
+from redis.asyncio import Redis
+
+from .gemini_client import get_gemini_client
+
+logger = logging.getLogger(__name__)
 
 
 class TranscriptionService:
     """Service for handling voice transcription and note generation"""
     
-    def __init__(self):
-        self.gemini_client = GeminiClient()
+    def __init__(self, redis: Optional[Redis] = None):
+        self.gemini_client = get_gemini_client()
+        # Shared transcript store; falls back to in-process storage when unset
+        self.redis = redis
         self.transcripts = {}  # Store transcripts by class_id
+        # Joined transcript text by class_id, tagged with the chunk count it covers
+        self._full_text_cache: Dict[str, Tuple[int, str]] = {}
+        # Generated notes by class_id, tagged with the chunk count they cover
+        self._notes_cache: Dict[str, Tuple[int, str]] = {}
         self.MAX_TOKENS = 2000  # Conservative limit for free tier
+        self.CHARS_PER_TOKEN = 4  # Rough average for English text
+
+    @staticmethod
+    def _redis_key(class_id: str) -> str:
+        return f"transcript:{class_id}"
         
-    def add_transcript_chunk(self, class_id: str, text: str, timestamp: str = None) -> None:
+    async def add_transcript_chunk(self, class_id: str, text: str, timestamp: str = None) -> None:
         """Add a chunk of transcribed text to the class transcript"""
         if not timestamp:
             timestamp = datetime.now().isoformat()
+
+        chunk = {
+            "text": text,
+            "timestamp": timestamp
+        }
+
+        if self.redis:
+            await self.redis.rpush(self._redis_key(class_id), msgpack.packb(chunk, use_bin_type=True))
+            return
             
         if class_id not in self.transcripts:
             self.transcripts[class_id] = []
             
-        self.transcripts[class_id].append({
-            "text": text,
-            "timestamp": timestamp
-        })
+        self.transcripts[class_id].append(chunk)
     
-    def get_transcript(self, class_id: str) -> List[Dict]:
+    async def get_transcript(self, class_id: str) -> List[Dict]:
         """Get the full transcript for a class"""
+        if self.redis:
+            raw_chunks = await self.redis.lrange(self._redis_key(class_id), 0, -1)
+            return [msgpack.unpackb(raw, raw=False) for raw in raw_chunks]
         return self.transcripts.get(class_id, [])
     
-    def _optimize_transcript_for_tokens(self, full_text: str) -> str:
-        """Optimize transcript text to fit within token limits"""
-        # Rough estimation: 1 token ≈ 4 characters
-        max_chars = self.MAX_TOKENS * 3  # Conservative estimate
+    def _get_full_text(self, class_id: str, transcript_chunks: List[Dict]) -> str:
+        """Get the joined transcript text, rebuilding it only after new chunks"""
+        # Transcripts are append-only, so the chunk count identifies a version
+        cached = self._full_text_cache.get(class_id)
+        if cached and cached[0] == len(transcript_chunks):
+            return cached[1]
+
+        full_text = " ".join(chunk["text"] for chunk in transcript_chunks)
+        self._full_text_cache[class_id] = (len(transcript_chunks), full_text)
+        return full_text
+
+    def _estimate_tokens(self, text: str) -> int:
+        """Estimate the token count of a piece of text without an API call"""
+        return len(text) // self.CHARS_PER_TOKEN + 1
+
+    def _optimize_transcript_for_tokens(self, class_id: str, transcript_chunks: List[Dict]) -> str:
+        """Select transcript chunks that fit within token limits"""
+        token_counts = [self._estimate_tokens(chunk["text"]) for chunk in transcript_chunks]
         
-        if len(full_text) <= max_chars:
-            return full_text
+        if sum(token_counts) <= self.MAX_TOKENS:
+            return self._get_full_text(class_id, transcript_chunks)
         
         # Take the most recent content (end of lecture is often summary)
-        # and some from the beginning (introduction/key topics)
-        beginning_chars = max_chars // 3
-        ending_chars = max_chars - beginning_chars
-        
-        beginning = full_text[:beginning_chars]
-        ending = full_text[-ending_chars:]
-        
+        # and some from the beginning (introduction/key topics), dropping
+        # whole chunks from the middle so sentences are rarely cut in half
+        chars_per_token = self.CHARS_PER_TOKEN
+        beginning_budget = self.MAX_TOKENS // 3
+        ending_budget = self.MAX_TOKENS - beginning_budget
+
+        beginning_end = 0
+        beginning_used = 0
+        while beginning_used + token_counts[beginning_end] <= beginning_budget:
+            beginning_used += token_counts[beginning_end]
+            beginning_end += 1
+
+        ending_start = len(transcript_chunks)
+        ending_used = 0
+        while (
+            ending_start > beginning_end
+            and ending_used + token_counts[ending_start - 1] <= ending_budget
+        ):
+            ending_start -= 1
+            ending_used += token_counts[ending_start]
+
+        # The chunks the loops stopped on fill what is left of each budget:
+        # the head of the first one and the tail of the last one, without
+        # overlapping when both stopped on the same chunk
+        head = ""
+        tail = ""
+        if ending_start > beginning_end:
+            head_chars = (beginning_budget - beginning_used) * chars_per_token
+            head = transcript_chunks[beginning_end]["text"][:head_chars]
+
+            tail_source = transcript_chunks[ending_start - 1]["text"]
+            if ending_start - 1 == beginning_end:
+                tail_source = tail_source[len(head):]
+            tail_chars = (ending_budget - ending_used) * chars_per_token
+            if tail_chars > 0:
+                tail = tail_source[-tail_chars:]
+
+        texts = [chunk["text"] for chunk in transcript_chunks]
+        beginning = " ".join(filter(None, texts[:beginning_end] + [head]))
+        ending = " ".join(filter(None, [tail] + texts[ending_start:]))
+
         return f"{beginning}...[CONTENT TRUNCATED FOR EFFICIENCY]...{ending}"
     
     async def generate_notes(self, class_id: str) -> Optional[str]:
         """Generate smart notes from the class transcript using AI"""
-        transcript_chunks = self.get_transcript(class_id)
+        transcript_chunks = await self.get_transcript(class_id)
         
         if not transcript_chunks:
             return None
+
+        # Reuse notes generated from the same transcript version
+        cached = self._notes_cache.get(class_id)
+        if cached and cached[0] == len(transcript_chunks):
+            return cached[1]
             
-        # Combine all transcript text
-        full_text = " ".join([chunk["text"] for chunk in transcript_chunks])
-        
-        # Optimize for token efficiency
-        optimized_text = self._optimize_transcript_for_tokens(full_text)
+        # Combine transcript text, optimized for token efficiency
+        optimized_text = self._optimize_transcript_for_tokens(class_id, transcript_chunks)
         
         # Ultra-efficient prompt for note generation
         prompt = f"""Create study notes from this lecture:
@@ -75,24 +151,23 @@ Format:
 Keep under 300 words, focus on exam-relevant content."""
 
         try:
-            response = self.gemini_client.model.generate_content(prompt)
-            return response.text.strip()
+            response = await self.gemini_client.model.generate_content_async(prompt)
+            notes = response.text.strip()
+            self._notes_cache[class_id] = (len(transcript_chunks), notes)
+            return notes
         except Exception as e:
-            print(f"Error generating notes: {e}")
+            logger.error("Error generating notes: %s", e)
             # Fallback: Create basic notes from transcript structure
-            return self._create_fallback_notes(transcript_chunks)
+            return self._create_fallback_notes(class_id, transcript_chunks)
     
-    def _create_fallback_notes(self, transcript_chunks: List[Dict]) -> str:
+    def _create_fallback_notes(self, class_id: str, transcript_chunks: List[Dict]) -> str:
         """Create basic notes when AI fails (no API calls)"""
         if not transcript_chunks:
             return "No content available for notes."
         
         # Extract key sentences (simple heuristic)
-        all_text = " ".join([chunk["text"] for chunk in transcript_chunks])
-        sentences = [s.strip() for s in all_text.split('.') if len(s.strip()) > 20]
-        
-        # Take first few and last few sentences as key points
-        key_sentences = sentences[:3] + sentences[-2:] if len(sentences) > 5 else sentences
+        all_text = self._get_full_text(class_id, transcript_chunks)
+        key_sentences = self._extract_key_sentences(all_text)
         
         notes = f"""LECTURE NOTES
 Generated: {datetime.now().strftime("%Y-%m-%d %H:%M")}
@@ -106,13 +181,35 @@ KEY POINTS:
         
         return notes
     
-    def clear_transcript(self, class_id: str) -> None:
+    @staticmethod
+    def _extract_key_sentences(text: str, head: int = 3, tail: int = 2) -> List[str]:
+        """Pick the first and last few substantial sentences in a single pass"""
+        first: List[str] = []
+        last: deque = deque(maxlen=tail)
+
+        for sentence in text.split('.'):
+            sentence = sentence.strip()
+            if len(sentence) <= 20:
+                continue
+            if len(first) < head:
+                first.append(sentence)
+            else:
+                last.append(sentence)
+
+        # Transcripts with head + tail sentences or fewer come back whole
+        return first + list(last)
+
+    async def clear_transcript(self, class_id: str) -> None:
         """Clear transcript for a class"""
+        if self.redis:
+            await self.redis.delete(self._redis_key(class_id))
         if class_id in self.transcripts:
             del self.transcripts[class_id]
+        self._full_text_cache.pop(class_id, None)
+        self._notes_cache.pop(class_id, None)
     
-    def export_notes(self, class_id: str, notes: str) -> str:
-        """Export notes as downloadable content"""
+    def export_notes(self, class_id: str, notes: str, chunk_size: int = 65536) -> Iterator[bytes]:
+        """Export notes as downloadable content, streamed as UTF-8 chunks"""
         timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         
         header = f"""INSTRUCTIFY CLASS NOTES
@@ -123,4 +220,6 @@ Generated: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
 
 """
         
-        return header + notes
+        yield header.encode("utf-8")
+        for start in range(0, len(notes), chunk_size):
+            yield notes[start:start + chunk_size].encode("utf-8")
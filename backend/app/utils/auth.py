@@ -1,3 +1,4 @@
+import secrets
 import uuid
 
 
@@ -7,7 +8,7 @@ class SimpleAuth:
     @staticmethod
     def generate_session_id() -> str:
         """Generate a simple session ID"""
-        return str(uuid.uuid4())
+        return uuid.uuid4().hex
 
     @staticmethod
     def validate_user_type(user_type: str) -> bool:
@@ -17,4 +18,4 @@ class SimpleAuth:
     @staticmethod
     def generate_class_id() -> str:
         """Generate a short, shareable class ID"""
-        return str(uuid.uuid4())[:8].upper()
+        return secrets.token_hex(4).upper()
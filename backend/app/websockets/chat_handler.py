@@ -1,25 +1,60 @@
-import json
+import asyncio
+import logging
 import uuid
+from collections import deque
 from datetime import datetime
-from typing import Dict, List
+from typing import Deque, Dict, List
 
+import orjson
 from fastapi import WebSocket
 
 from ..models.chat import ChatMessage
-from ..services.gemini_client import GeminiClient
+from ..services.gemini_client import get_gemini_client
+
+logger = logging.getLogger(__name__)
+
+# Pre-encoded payloads for fixed replies; only the query (JSON-encoded) and
+# the timestamp are spliced in per send
+_BLOCKED_TEMPLATE = '{"type":"message_blocked","reason":%s,"timestamp":"%%s"}' % (
+    orjson.dumps(
+        "Your message was blocked for inappropriate content. Please keep our "
+        "classroom discussions educational and respectful."
+    ).decode()
+)
+_AI_UNAVAILABLE_TEMPLATE = (
+    '{"type":"ai_response","query":%%s,"response":%s,"timestamp":"%%s"}'
+    % orjson.dumps(
+        "Sorry, I'm having trouble processing your question right now. "
+        "Please try again or ask your teacher directly."
+    ).decode()
+)
+_AI_ERROR_TEMPLATE = (
+    '{"type":"ai_response","query":%%s,"response":%s,"timestamp":"%%s"}'
+    % orjson.dumps(
+        "I'm experiencing technical difficulties. Please try again later."
+    ).decode()
+)
 
 
 class ChatHandler:
+    # Per-class history kept in memory, and teacher messages used as AI context
+    HISTORY_LIMIT = 500
+    CONTEXT_LIMIT = 10
+
     def __init__(self, room_manager=None):
-        self.messages: Dict[str, List[ChatMessage]] = {}  # class_id -> messages
+        self.messages: Dict[str, Deque[ChatMessage]] = {}  # class_id -> messages
+        # Pre-formatted teacher messages for AI context: class_id -> lines
+        self.teacher_context: Dict[str, Deque[str]] = {}
+        # Joined teacher context, dropped whenever a teacher message arrives
+        self._context_cache: Dict[str, str] = {}
         self.room_manager = room_manager
         
         # GeminiClient for AI chat responses and content filtering
         try:
-            self.gemini_client = GeminiClient()
+            self.gemini_client = get_gemini_client()
         except ValueError as e:
-            print(f"Warning: GeminiClient initialization failed: {e}")
-            print("Content filtering and AI responses will be disabled.")
+            logger.warning("GeminiClient initialization failed: %s", e)
+            logger.warning("Content filtering and AI responses will be disabled.")
             self.gemini_client = None
 
     async def handle_message(
@@ -37,7 +72,7 @@ class ChatHandler:
         elif message_type == "whiteboard_draw":
             await self.handle_whiteboard_draw(class_id, websocket, message_data)
         else:
-            print(f"❓ Unknown message type: {message_type}")
+            logger.warning("Unknown message type: %s", message_type)
 
     async def handle_chat_message(
         self, class_id: str, websocket: WebSocket, message_data: dict
@@ -51,38 +86,50 @@ class ChatHandler:
         sender_type = sender_info.get("user_type", "student")
         message_text = message_data.get("message", "")
 
+        # Classify student messages while the content filter runs; the
+        # classification is dropped if the message gets blocked
+        classify_task = None
+        if sender_type == "student" and self.gemini_client:
+            context = self._get_recent_context(class_id)
+            classify_task = asyncio.create_task(
+                self.gemini_client.classify_doubt(message_text, context)
+            )
+
         # First, filter all messages for harmful content
         if self.gemini_client:
             try:
                 content_filter = await self.gemini_client.filter_content(message_text)
                 if not content_filter.get("is_safe", False):
+                    if classify_task:
+                        classify_task.cancel()
+
                     # Block harmful message - don't broadcast it
-                    print(f"🚫 Blocked harmful chat message from {sender_name}: {message_text}")
-                    print(f"Filter reason: {content_filter.get('reason')} (Filter type: {content_filter.get('filter_type')})")
-                    
+                    logger.info(
+                        "Blocked harmful chat message from %s: %s (%s, filter type: %s)",
+                        sender_name,
+                        message_text,
+                        content_filter.get("reason"),
+                        content_filter.get("filter_type"),
+                    )
+
                     # Send warning to sender only
-                    await websocket.send_text(json.dumps({
-                        "type": "message_blocked",
-                        "reason": "Your message was blocked for inappropriate content. Please keep our classroom discussions educational and respectful.",
-                        "timestamp": datetime.now().isoformat(),
-                    }))
+                    await websocket.send_text(
+                        _BLOCKED_TEMPLATE % datetime.now().isoformat()
+                    )
                     return  # Don't process or broadcast the message
             except Exception as e:
-                print(f"Content filtering error: {e}")
+                logger.error("Content filtering error: %s", e)
                 # On error, allow message but log the issue
         else:
-            print("Warning: No content filtering available - GeminiClient not initialized")
+            logger.debug("No content filtering available - GeminiClient not initialized")
         
         # For students, check if this is a genuine doubt for the teacher
         is_doubt = False
         if sender_type == "student":
             try:
-                # Get context and classify the message
-                context = self._get_recent_context(class_id)
-                if self.gemini_client:
-                    classification = await self.gemini_client.classify_doubt(
-                        message_text, context
-                    )
+                # Use the classification started alongside the filter
+                if classify_task:
+                    classification = await classify_task
                 else:
                     # Fallback - no classification available
                     classification = {
@@ -96,8 +143,9 @@ class ChatHandler:
                 # If it's a genuine doubt, flag it for teacher attention
                 if is_doubt:
                     # Send special notification to teachers
-                    await self.room_manager.send_to_teachers(
+                    self.room_manager.enqueue(
                         class_id,
+                        "teachers",
                         {
                             "type": "doubt_notification",
                             "student_name": sender_name,
@@ -106,12 +154,12 @@ class ChatHandler:
                             "reason": classification.get(
                                 "reason", "Classified as academic question"
                             ),
-                            "timestamp": datetime.now().isoformat(),
+                            "timestamp": datetime.now(),
                         },
                     )
 
             except Exception as e:
-                print(f"Doubt classification error: {e}")
+                logger.error("Doubt classification error: %s", e)
                 # If classification fails, treat as regular message
 
         # Create chat message
@@ -127,9 +175,17 @@ class ChatHandler:
 
         # Store message
         if class_id not in self.messages:
-            self.messages[class_id] = []
+            self.messages[class_id] = deque(maxlen=self.HISTORY_LIMIT)
         self.messages[class_id].append(chat_message)
 
+        if sender_type == "teacher":
+            if class_id not in self.teacher_context:
+                self.teacher_context[class_id] = deque(maxlen=self.CONTEXT_LIMIT)
+            self.teacher_context[class_id].append(
+                f"Teacher ({sender_name}): {message_text}"
+            )
+            self._context_cache.pop(class_id, None)
+
         # Broadcast to all users in room
         await self.room_manager.broadcast_to_room(
             class_id,
@@ -139,7 +195,7 @@ class ChatHandler:
                 "sender_name": chat_message.sender_name,
                 "sender_type": chat_message.sender_type,
                 "message": chat_message.message,
-                "timestamp": chat_message.timestamp.isoformat(),
+                "timestamp": chat_message.timestamp,
                 "is_doubt": is_doubt,
             },
         )
@@ -167,59 +223,35 @@ class ChatHandler:
 
             if ai_response:
                 await websocket.send_text(
-                    json.dumps(
+                    orjson.dumps(
                         {
                             "type": "ai_response",
                             "query": query,
                             "response": ai_response,
-                            "timestamp": datetime.now().isoformat(),
+                            "timestamp": datetime.now(),
                         }
-                    )
+                    ).decode()
                 )
             else:
                 await websocket.send_text(
-                    json.dumps(
-                        {
-                            "type": "ai_response",
-                            "query": query,
-                            "response": (
-                                "Sorry, I'm having trouble processing your "
-                                "question right now. Please try again or "
-                                "ask your teacher directly."
-                            ),
-                            "timestamp": datetime.now().isoformat(),
-                        }
-                    )
+                    _AI_UNAVAILABLE_TEMPLATE
+                    % (orjson.dumps(query).decode(), datetime.now().isoformat())
                 )
         except Exception as e:
-            print(f"AI query error: {e}")
+            logger.error("AI query error: %s", e)
             await websocket.send_text(
-                json.dumps(
-                    {
-                        "type": "ai_response",
-                        "query": query,
-                        "response": (
-                            "I'm experiencing technical difficulties. "
-                            "Please try again later."
-                        ),
-                        "timestamp": datetime.now().isoformat(),
-                    }
-                )
+                _AI_ERROR_TEMPLATE
+                % (orjson.dumps(query).decode(), datetime.now().isoformat())
             )
 
-    def _get_recent_context(self, class_id: str, limit: int = 10) -> str:
-        """Get recent chat messages as context for AI"""
-        if class_id not in self.messages:
-            return ""
-
-        recent_messages = self.messages[class_id][-limit:]
-        context_parts = []
-
-        for msg in recent_messages:
-            if msg.sender_type == "teacher":
-                context_parts.append(f"Teacher ({msg.sender_name}): {msg.message}")
+    def _get_recent_context(self, class_id: str) -> str:
+        """Get recent teacher messages as context for AI"""
+        if (cached := self._context_cache.get(class_id)) is not None:
+            return cached
 
-        return "\n".join(context_parts)
+        context = "\n".join(self.teacher_context.get(class_id, ()))
+        self._context_cache[class_id] = context
+        return context
 
     async def handle_webrtc_signal(
         self, class_id: str, websocket: WebSocket, message_data: dict
@@ -228,9 +260,13 @@ class ChatHandler:
         if not self.room_manager:
             return
 
-        print(f"🔧 Backend handling WebRTC signal: {message_data.get('signal_type')}")
-        print(f"📋 Full message data: {message_data}")
-        
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Handling WebRTC signal %s: %s",
+                message_data.get("signal_type"),
+                message_data,
+            )
+
         # Use the new WebRTC signaling handler
         await self.room_manager.handle_webrtc_signaling(class_id, websocket, message_data)
 
@@ -245,26 +281,26 @@ class ChatHandler:
         sender_type = sender_info.get("user_type", "student")
         sender_name = sender_info.get("user_name", "Anonymous")
         
-        print(f"🎨 Whiteboard draw from {sender_name} ({sender_type})")
-        
+        logger.debug("Whiteboard draw from %s (%s)", sender_name, sender_type)
+
         # Only teachers can draw on whiteboard
         if sender_type != "teacher":
-            print(f"❌ Non-teacher {sender_name} tried to draw on whiteboard")
+            logger.warning("Non-teacher %s tried to draw on whiteboard", sender_name)
             return
 
         drawing_data = message_data.get("drawing_data", {})
-        print(f"📝 Broadcasting drawing data: {drawing_data}")
-        
+        logger.debug("Broadcasting drawing data: %s", drawing_data)
+
         # Broadcast drawing data to all students
         await self.room_manager.broadcast_to_students(
             class_id,
             {
                 "type": "whiteboard_update",
                 "drawing_data": drawing_data,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": datetime.now(),
             }
         )
-        print(f"✅ Whiteboard update sent to students in class {class_id}")
+        logger.debug("Whiteboard update sent to students in class %s", class_id)
 
     def get_chat_history(self, class_id: str) -> List[dict]:
         """Get chat history for a classroom"""
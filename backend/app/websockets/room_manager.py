@@ -1,20 +1,49 @@
-import json
+import asyncio
+import logging
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Set, Tuple
 
+import orjson
 from fastapi import WebSocket
 
 from ..models.classroom import Classroom, User
 
+logger = logging.getLogger(__name__)
+
+
+def _dumps(message: dict) -> str:
+    """Encode a message as a JSON text frame; datetimes are encoded natively"""
+    return orjson.dumps(message, option=orjson.OPT_NON_STR_KEYS).decode()
+
 
 class RoomManager:
+    # Rooms larger than this are sent to in batches, yielding in between
+    BROADCAST_BATCH_SIZE = 50
+    # Seconds that enqueued messages wait to be coalesced into one frame
+    FLUSH_DELAY = 0.02
+    # Seconds a single socket write may take before the client counts as failed
+    SEND_TIMEOUT = 5.0
+
     def __init__(self):
         # Store active rooms: class_id -> Classroom
         self.rooms: Dict[str, Classroom] = {}
-        # Store WebSocket connections: class_id -> List[WebSocket]
-        self.connections: Dict[str, List[WebSocket]] = {}
+        # Store WebSocket connections in join order: class_id -> {WebSocket: None}
+        self.connections: Dict[str, Dict[WebSocket, None]] = {}
         # Store user info per connection: websocket -> user_info
         self.user_connections: Dict[WebSocket, Dict] = {}
+        # Role indexes so targeted sends skip other users: class_id -> Set[WebSocket]
+        self.students: Dict[str, Set[WebSocket]] = {}
+        self.teachers: Dict[str, Set[WebSocket]] = {}
+        # Connections by id() for direct signaling: class_id -> {id: WebSocket}
+        self.conn_by_id: Dict[str, Dict[int, WebSocket]] = {}
+        # Bound concurrent socket writes during large broadcasts
+        self._send_limit = asyncio.Semaphore(100)
+        # Messages waiting to be coalesced: (class_id, audience) -> messages
+        self._outbox: Dict[Tuple[str, str], List[dict]] = {}
+        # Pending flush per outbox key
+        self._flush_handles: Dict[Tuple[str, str], asyncio.TimerHandle] = {}
+        # Flushes and socket closes running in the background
+        self._background_tasks: Set[asyncio.Task] = set()
 
     async def create_room(self, class_id: str, teacher_name: str) -> Classroom:
         """Create a new classroom"""
@@ -25,7 +54,7 @@ class RoomManager:
             is_active=True,
         )
         self.rooms[class_id] = classroom
-        self.connections[class_id] = []
+        self.connections[class_id] = {}
         return classroom
 
     def get_room(self, class_id: str) -> Optional[Classroom]:
@@ -37,10 +66,10 @@ class RoomManager:
     ):
         """Add user to a classroom"""
         if class_id not in self.connections:
-            self.connections[class_id] = []
+            self.connections[class_id] = {}
 
         # Add WebSocket connection
-        self.connections[class_id].append(websocket)
+        self.connections[class_id][websocket] = None
 
         # Store user info
         self.user_connections[websocket] = {
@@ -49,6 +78,13 @@ class RoomManager:
             "user_name": user_name,
         }
 
+        # Index the connection by role and by id
+        if user_type == "student":
+            self.students.setdefault(class_id, set()).add(websocket)
+        elif user_type == "teacher":
+            self.teachers.setdefault(class_id, set()).add(websocket)
+        self.conn_by_id.setdefault(class_id, {})[id(websocket)] = websocket
+
         # Add user to classroom
         if class_id in self.rooms:
             user = User(name=user_name, user_type=user_type, joined_at=datetime.now())
@@ -68,36 +104,46 @@ class RoomManager:
 
     async def remove_user_from_room(self, class_id: str, websocket: WebSocket):
         """Remove user from classroom"""
-        if websocket in self.user_connections:
-            user_info = self.user_connections[websocket]
-            user_name = user_info["user_name"]
-            user_type = user_info["user_type"]
+        left = self._detach_users(class_id, [websocket])
+        if left:
+            # Notify other users
+            await self.broadcast_to_room(class_id, left[0])
+
+    def _detach_users(self, class_id: str, websockets: List[WebSocket]) -> List[dict]:
+        """Remove users without notifying anyone, returning their user_left messages"""
+        left = []
+        for websocket in websockets:
+            user_info = self.user_connections.pop(websocket, None)
+            if user_info is None:
+                continue
 
             # Remove from connections
-            if class_id in self.connections:
-                self.connections[class_id].remove(websocket)
-
-            # Remove user from classroom
-            if class_id in self.rooms:
-                self.rooms[class_id].users = [
-                    user
-                    for user in self.rooms[class_id].users
-                    if user.name != user_name
-                ]
-
-                # Notify other users
-                await self.broadcast_to_room(
-                    class_id,
-                    {
-                        "type": "user_left",
-                        "user_name": user_name,
-                        "user_type": user_type,
-                        "user_count": len(self.rooms[class_id].users),
-                    },
-                )
+            self._drop_connection(class_id, websocket)
+            left.append(
+                {
+                    "type": "user_left",
+                    "user_name": user_info["user_name"],
+                    "user_type": user_info["user_type"],
+                }
+            )
+
+        room = self.rooms.get(class_id)
+        if not left or room is None:
+            return []
+
+        # Remove users from classroom
+        names = {message["user_name"] for message in left}
+        room.users = [user for user in room.users if user.name not in names]
+        for message in left:
+            message["user_count"] = len(room.users)
+        return left
 
-            # Clean up
-            del self.user_connections[websocket]
+    def _drop_connection(self, class_id: str, websocket: WebSocket):
+        """Remove a connection from the room's connection list and indexes"""
+        self.connections.get(class_id, {}).pop(websocket, None)
+        self.students.get(class_id, set()).discard(websocket)
+        self.teachers.get(class_id, set()).discard(websocket)
+        self.conn_by_id.get(class_id, {}).pop(id(websocket), None)
 
     async def broadcast_to_room(
         self, class_id: str, message: dict, exclude: Optional[WebSocket] = None
@@ -106,72 +152,136 @@ class RoomManager:
         if class_id not in self.connections:
             return
 
-        message_str = json.dumps(message)
-        disconnected = []
+        message_str = _dumps(message)
+        targets = [
+            connection
+            for connection in self.connections[class_id]
+            if connection is not exclude
+        ]
+        disconnected = await self._fan_out(targets, message_str)
 
-        for connection in self.connections[class_id]:
-            if exclude and connection == exclude:
-                continue
+        # Clean up disconnected connections
+        await self._evict(class_id, disconnected)
+
+    async def _evict(self, class_id: str, connections: List[WebSocket]):
+        """Detach and close failed connections, announcing them in one frame"""
+        if not connections:
+            return
 
+        # Closing makes a stalled client reconnect instead of staying attached
+        # but unreachable; its own cleanup then finds nothing left to remove
+        left = self._detach_users(class_id, connections)
+        for connection in connections:
+            self._spawn(self._close(connection))
+
+        # One notification rather than one broadcast per departure
+        if left:
+            message = left[0] if len(left) == 1 else {"type": "batch", "items": left}
+            await self.broadcast_to_room(class_id, message)
+
+    async def _close(self, connection: WebSocket):
+        """Close a connection with an error code, giving up if the write stalls"""
+        try:
+            await asyncio.wait_for(connection.close(code=1011), self.SEND_TIMEOUT)
+        except Exception as e:
+            logger.debug("Could not close failed connection: %s", e)
+
+    def _spawn(self, coro):
+        """Run a coroutine in the background, keeping a reference until it ends"""
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _safe_send(self, connection: WebSocket, frame: dict) -> bool:
+        """Send to one connection, reporting failure or a stall instead of raising"""
+        async with self._send_limit:
             try:
-                await connection.send_text(message_str)
+                # A client that stops reading would otherwise hold its send
+                # slot, and the broadcast waiting on it, indefinitely
+                await asyncio.wait_for(connection.send(frame), self.SEND_TIMEOUT)
+                return True
             except Exception:
-                disconnected.append(connection)
+                return False
+
+    async def _fan_out(
+        self, connections: List[WebSocket], message_str: str
+    ) -> List[WebSocket]:
+        """Send to connections concurrently and return the ones that failed"""
+        batch_size = self.BROADCAST_BATCH_SIZE
+        results: List[bool] = []
+
+        # One ASGI send message shared by every recipient
+        frame = {"type": "websocket.send", "text": message_str}
+
+        for start in range(0, len(connections), batch_size):
+            if start:
+                # Let HTTP handlers and incoming frames run between batches
+                await asyncio.sleep(0)
+            results += await asyncio.gather(
+                *(
+                    self._safe_send(connection, frame)
+                    for connection in connections[start:start + batch_size]
+                )
+            )
 
-        # Clean up disconnected connections
-        for conn in disconnected:
-            await self.remove_user_from_room(class_id, conn)
+        return [
+            connection for connection, sent in zip(connections, results) if not sent
+        ]
+
+    async def send_to_teachers(self, class_id: str, message: dict):
+        """Send message only to teachers in the room"""
+        await self._send_raw_to_teachers(class_id, _dumps(message))
 
-    async def broadcast_to_students(self, class_id: str, message: dict):
-        """Send message only to students in the room"""
+    async def _send_raw_to_teachers(self, class_id: str, message_str: str):
+        """Send an already encoded message to the teachers in the room"""
         if class_id not in self.connections:
-            print(f"❌ No connections found for class {class_id}")
             return
 
-        message_str = json.dumps(message)
-        disconnected = []
-        student_count = 0
+        teachers = list(self.teachers.get(class_id, ()))
 
-        for connection in self.connections[class_id]:
-            user_info = self.user_connections.get(connection, {})
-            if user_info.get("user_type") == "student":
-                student_count += 1
-                try:
-                    await connection.send_text(message_str)
-                    print(f"✅ Sent whiteboard update to student: {user_info.get('user_name', 'Unknown')}")
-                except Exception as e:
-                    print(f"❌ Failed to send to student: {e}")
-                    disconnected.append(connection)
+        failed = await self._fan_out(teachers, message_str)
+        if logger.isEnabledFor(logging.DEBUG):
+            for connection in failed:
+                user_name = self.user_connections.get(connection, {}).get("user_name", "Unknown")
+                logger.debug("Failed to send to teacher %s", user_name)
+            logger.debug("Sent message to %d teachers", len(teachers) - len(failed))
 
-        print(f"📊 Broadcast to {student_count} students in class {class_id}")
+        # Clean up disconnected or stalled connections
+        await self._evict(class_id, failed)
 
-        # Clean up disconnected connections
-        for conn in disconnected:
-            await self.remove_user_from_room(class_id, conn)
+        if not teachers:
+            logger.debug("No teachers found in class %s", class_id)
 
-    async def send_to_teachers(self, class_id: str, message: dict):
-        """Send message only to teachers in the room"""
-        if class_id not in self.connections:
+    def enqueue(self, class_id: str, audience: str, message: dict):
+        """Queue a message for "teachers" or "students" to go out with its burst"""
+        key = (class_id, audience)
+        self._outbox.setdefault(key, []).append(message)
+        if key not in self._flush_handles:
+            self._flush_handles[key] = asyncio.get_running_loop().call_later(
+                self.FLUSH_DELAY, self._start_flush, key
+            )
+
+    def _start_flush(self, key: Tuple[str, str]):
+        """Timer callback: run the flush for an outbox key as a task"""
+        del self._flush_handles[key]
+        self._spawn(self._flush(key))
+
+    async def _flush(self, key: Tuple[str, str]):
+        """Send queued messages as one frame, batching only when there are several"""
+        messages = self._outbox.pop(key, None)
+        if not messages:
             return
 
-        message_str = json.dumps(message)
-
-        teachers_found = 0
-
-        for connection in self.connections[class_id]:
-            if connection in self.user_connections:
-                user_info = self.user_connections[connection]
-                if user_info["user_type"] == "teacher":
-                    teachers_found += 1
-                    try:
-                        await connection.send_text(message_str)
-                        print(f"✅ Sent message to teacher: {user_info['user_name']}")
-                    except Exception as e:
-                        print(f"❌ Failed to send to teacher {user_info['user_name']}: {e}")
-        
-        print(f"📤 Sent message to {teachers_found} teachers")
-        if teachers_found == 0:
-            print(f"⚠️  No teachers found in class {class_id}")
+        class_id, audience = key
+        if len(messages) == 1:
+            message = messages[0]
+        else:
+            message = {"type": "batch", "items": messages}
+
+        if audience == "teachers":
+            await self.send_to_teachers(class_id, message)
+        else:
+            await self.broadcast_to_students(class_id, message)
 
     def get_room_users(self, class_id: str) -> List[Dict]:
         """Get list of users in a room"""
@@ -185,99 +295,102 @@ class RoomManager:
         """Handle WebRTC signaling messages (offer, answer, ICE candidates)"""
         sender_info = self.user_connections.get(sender)
         if not sender_info:
-            print("❌ No sender info found for WebRTC signaling")
+            logger.warning("No sender info found for WebRTC signaling")
             return
 
-        print(f"📡 Backend WebRTC signaling: {message.get('signal_type')} from {sender_info['user_type']} ({sender_info['user_name']})")
+        user_type = sender_info["user_type"]
+        user_name = sender_info["user_name"]
+        signal_type = message.get("signal_type")
+        recipient_id = message.get("recipient_id")
+        logger.debug("WebRTC signaling: %s from %s (%s)", signal_type, user_type, user_name)
 
         # Add sender information to the message
         message["sender_id"] = id(sender)
-        message["sender_type"] = sender_info["user_type"]
-        message["sender_name"] = sender_info["user_name"]
+        message["sender_type"] = user_type
+        message["sender_name"] = user_name
         message["type"] = "webrtc_signal"  # Ensure correct message type
 
-        signal_type = message.get("signal_type")
-        
+        if signal_type == "ice_candidate" and recipient_id is None:
+            # ICE candidates from teacher go to all students, from students go
+            # to teacher; they are coalesced and encoded when the burst flushes
+            if user_type == "teacher":
+                logger.debug("Broadcasting teacher ICE candidate to students")
+                self.enqueue(class_id, "students", message)
+            else:
+                logger.debug("Sending student ICE candidate to teachers")
+                self.enqueue(class_id, "teachers", message)
+            return
+
+        # Every other signal goes to a single audience, so encode it once here
+        payload = _dumps(message)
+
         # Forward signaling message to appropriate recipients
-        if signal_type == "student_ready" and sender_info["user_type"] == "student":
-            print(f"📤 Student {sender_info['user_name']} ready - notifying teacher")
+        if signal_type == "student_ready" and user_type == "student":
+            logger.debug("Student %s ready - notifying teacher", user_name)
             # Student ready signal goes to teacher
-            await self.send_to_teachers(class_id, message)
-        elif signal_type == "offer" and sender_info["user_type"] == "teacher":
+            await self._send_raw_to_teachers(class_id, payload)
+        elif signal_type == "offer" and user_type == "teacher":
             # Teacher sending individual offer to specific student
-            if "recipient_id" in message:
-                print(f"📤 Teacher sending offer to specific student {message['recipient_id']}")
-                await self.send_to_specific_user(class_id, message["recipient_id"], message)
+            if recipient_id is not None:
+                logger.debug("Teacher sending offer to student %s", recipient_id)
+                await self._send_raw_to_user(class_id, recipient_id, payload)
             else:
-                print(f"📤 Teacher broadcasting offer to all students")
-                await self.broadcast_to_students(class_id, message, exclude=sender)
-        elif signal_type == "answer" and sender_info["user_type"] == "student":
+                logger.debug("Teacher broadcasting offer to all students")
+                await self._broadcast_raw_to_students(class_id, payload, exclude=sender)
+        elif signal_type == "answer" and user_type == "student":
             # Student sending answer back to teacher - route to specific teacher
-            print(f"📤 Student {sender_info['user_name']} sending answer to teacher")
-            await self.send_to_teachers(class_id, message)
+            logger.debug("Student %s sending answer to teacher", user_name)
+            await self._send_raw_to_teachers(class_id, payload)
         elif signal_type == "ice_candidate":
-            # Forward to specific recipient if specified, otherwise broadcast appropriately
-            if "recipient_id" in message:
-                print(f"📤 Forwarding ICE candidate to specific recipient {message['recipient_id']}")
-                await self.send_to_specific_user(class_id, message["recipient_id"], message)
-            else:
-                # ICE candidates from teacher go to all students, from students go to teacher
-                if sender_info["user_type"] == "teacher":
-                    print(f"📤 Broadcasting teacher ICE candidate to students")
-                    await self.broadcast_to_students(class_id, message, exclude=sender)
-                else:
-                    print(f"📤 Sending student ICE candidate to teachers")
-                    await self.send_to_teachers(class_id, message)
+            # Forward to the specific recipient
+            logger.debug("Forwarding ICE candidate to %s", recipient_id)
+            await self._send_raw_to_user(class_id, recipient_id, payload)
 
     async def broadcast_to_students(
         self, class_id: str, message: dict, exclude: Optional[WebSocket] = None
     ):
         """Broadcast message only to students in the room"""
+        await self._broadcast_raw_to_students(class_id, _dumps(message), exclude)
+
+    async def _broadcast_raw_to_students(
+        self, class_id: str, message_str: str, exclude: Optional[WebSocket] = None
+    ):
+        """Broadcast an already encoded message to the students in the room"""
         if class_id not in self.connections:
-            print(f"❌ No connections found for class {class_id}")
+            logger.debug("No connections found for class %s", class_id)
             return
 
-        message_str = json.dumps(message)
-        disconnected = []
-        student_count = 0
-
-        for connection in self.connections[class_id]:
-            if exclude and connection == exclude:
-                continue
-
-            # Check if this connection belongs to a student
-            user_info = self.user_connections.get(connection)
-            if user_info and user_info["user_type"] == "student":
-                student_count += 1
-                try:
-                    await connection.send_text(message_str)
-                    print(f"✅ Sent WebRTC signal to student: {user_info['user_name']}")
-                except Exception as e:
-                    print(f"❌ Failed to send to student {user_info['user_name']}: {e}")
-                    disconnected.append(connection)
+        students = [
+            connection
+            for connection in self.students.get(class_id, ())
+            if connection is not exclude
+        ]
 
-        print(f"📤 Sent WebRTC signal to {student_count} students")
+        disconnected = await self._fan_out(students, message_str)
+        if logger.isEnabledFor(logging.DEBUG):
+            for connection in disconnected:
+                user_name = self.user_connections.get(connection, {}).get("user_name", "Unknown")
+                logger.debug("Failed to send to student %s", user_name)
+            logger.debug("Sent message to %d students", len(students) - len(disconnected))
 
-        # Clean up disconnected connections
-        for conn in disconnected:
-            if conn in self.connections[class_id]:
-                self.connections[class_id].remove(conn)
+        # Clean up disconnected or stalled connections
+        await self._evict(class_id, disconnected)
 
     async def send_to_specific_user(
         self, class_id: str, recipient_id: int, message: dict
     ):
         """Send message to a specific user by connection ID"""
-        if class_id not in self.connections:
+        await self._send_raw_to_user(class_id, recipient_id, _dumps(message))
+
+    async def _send_raw_to_user(
+        self, class_id: str, recipient_id: int, message_str: str
+    ):
+        """Send an already encoded message to a specific user by connection ID"""
+        connection = self.conn_by_id.get(class_id, {}).get(recipient_id)
+        if connection is None:
             return
 
-        message_str = json.dumps(message)
-        
-        for connection in self.connections[class_id]:
-            if id(connection) == recipient_id:
-                try:
-                    await connection.send_text(message_str)
-                except Exception:
-                    # Remove disconnected connection
-                    if connection in self.connections[class_id]:
-                        self.connections[class_id].remove(connection)
-                break
+        frame = {"type": "websocket.send", "text": message_str}
+        if not await self._safe_send(connection, frame):
+            # Remove disconnected or stalled connection
+            await self._evict(class_id, [connection])
@@ -0,0 +1,90 @@
+import unittest
+
+import google.generativeai as genai
+
+from app.services.gemini_client import _DOUBT_CONFIG, _DOUBT_HINT, _FILTER_CONFIG
+
+
+class StructuredOutputConfigTest(unittest.TestCase):
+    """The response schemas must convert into a request on every supported Python"""
+
+    def setUp(self):
+        self.model = genai.GenerativeModel("gemini-2.0-flash-exp")
+
+    def _prepare(self, generation_config):
+        return self.model._prepare_request(
+            contents="Can you explain photosynthesis please",
+            generation_config=generation_config,
+            safety_settings=None,
+            tools=None,
+            tool_config=None,
+        )
+
+    def test_filter_config_builds_request(self):
+        request = self._prepare(_FILTER_CONFIG)
+        schema = request.generation_config.response_schema
+        self.assertEqual(
+            set(schema.properties), {"is_safe", "confidence", "reason", "category"}
+        )
+        self.assertEqual(
+            request.generation_config.response_mime_type, "application/json"
+        )
+
+    def test_doubt_config_builds_request(self):
+        request = self._prepare(_DOUBT_CONFIG)
+        schema = request.generation_config.response_schema
+        self.assertEqual(
+            set(schema.properties),
+            {"is_genuine_doubt", "confidence", "reason", "category"},
+        )
+
+
+class DoubtHintTest(unittest.TestCase):
+    """Messages that might be doubts reach the model; plain chatter does not"""
+
+    POSSIBLE_DOUBTS = [
+        "what is a derivative",
+        "Why does the sign flip here",
+        "explain step 3 again",
+        "2+2?",
+        "I'm confused about the chain rule",
+        "i don't get it",
+        "I don’t get the last example",
+        "i dont know how to start q2",
+        "I'm stuck on q3",
+        "help me with integrals",
+        "totally lost after the second slide",
+        "not sure what the homework is",
+        "I didn't understand the proof",
+        "sir what is a limit",
+        "teacher how do we solve q4",
+        "please explain step 2 again",
+        "I have a question about the homework",
+        "ma'am could you go over that again",
+        "miss can we see the graph again",
+        "what does this term mean",
+    ]
+    CHATTER = [
+        "ok",
+        "thanks",
+        "hello everyone",
+        "good morning",
+        "see you tomorrow",
+        "nice example",
+        "brb",
+        "I agree with that",
+    ]
+
+    def test_possible_doubts_match(self):
+        for message in self.POSSIBLE_DOUBTS:
+            with self.subTest(message=message):
+                self.assertTrue(_DOUBT_HINT.search(message.strip().lower()))
+
+    def test_chatter_does_not_match(self):
+        for message in self.CHATTER:
+            with self.subTest(message=message):
+                self.assertFalse(_DOUBT_HINT.search(message.strip().lower()))
+
+
+if __name__ == "__main__":
+    unittest.main()
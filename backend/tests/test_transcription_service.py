@@ -0,0 +1,53 @@
+import unittest
+from unittest import mock
+
+from app.services.transcription_service import TranscriptionService
+
+MARKER = "...[CONTENT TRUNCATED FOR EFFICIENCY]..."
+
+
+class OptimizeTranscriptTest(unittest.TestCase):
+    """Transcript selection stays within the token budget and uses most of it"""
+
+    def setUp(self):
+        with mock.patch("app.services.transcription_service.get_gemini_client"):
+            self.service = TranscriptionService()
+
+    def _optimize(self, texts):
+        chunks = [{"text": text, "timestamp": ""} for text in texts]
+        return self.service._optimize_transcript_for_tokens("class", chunks)
+
+    def _budget_chars(self):
+        return self.service.MAX_TOKENS * self.service.CHARS_PER_TOKEN
+
+    def test_short_transcript_is_returned_whole(self):
+        self.assertEqual(self._optimize(["one", "two"]), "one two")
+
+    def test_oversized_first_chunk_contributes_head_and_tail(self):
+        result = self._optimize(["a" * 9000, "b" * 10])
+        beginning, ending = result.split(MARKER)
+
+        self.assertTrue(beginning.startswith("a" * 100))
+        self.assertTrue(ending.endswith(" " + "b" * 10))
+        body = len(beginning) + len(ending)
+        self.assertGreater(body, self._budget_chars() * 0.9)
+        self.assertLessEqual(body, self._budget_chars())
+
+    def test_oversized_middle_chunk_is_sliced_at_both_ends(self):
+        result = self._optimize(["a" * 100, "m" * 20000, "z" * 100])
+        beginning, ending = result.split(MARKER)
+
+        self.assertTrue(beginning.startswith("a" * 100 + " m"))
+        self.assertTrue(ending.endswith("m " + "z" * 100))
+        self.assertLessEqual(len(beginning) + len(ending), self._budget_chars())
+
+    def test_whole_chunks_are_kept_when_they_fit(self):
+        texts = [chr(ord("a") + i) * 400 for i in range(26)]
+        beginning, ending = self._optimize(texts).split(MARKER)
+
+        self.assertTrue(beginning.startswith(texts[0] + " " + texts[1]))
+        self.assertTrue(ending.endswith(texts[-2] + " " + texts[-1]))
+
+
+if __name__ == "__main__":
+    unittest.main()
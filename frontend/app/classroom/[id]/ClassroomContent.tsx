@@ -170,11 +170,15 @@ export default function ClassroomContent({ classId }: { classId: string }) {
         }));
       };
 
-      ws.onmessage = async (event) => {
-        const data = JSON.parse(event.data);
-        console.log(`🔔 [${role.toUpperCase()}] Received:`, data);
-
+      // eslint-disable-next-line @typescript-eslint/no-explicit-any
+      const handleServerMessage = async (data: any) => {
         switch (data.type) {
+          case 'batch':
+            // Messages coalesced by the server, handled in order
+            for (const item of data.items) {
+              await handleServerMessage(item);
+            }
+            break;
           case 'connection_confirmed':
             setIsConnected(true);
             break;
@@ -231,6 +235,12 @@ export default function ClassroomContent({ classId }: { classId: string }) {
         }
       };
 
+      ws.onmessage = async (event) => {
+        const data = JSON.parse(event.data);
+        console.log(`🔔 [${role.toUpperCase()}] Received:`, data);
+        await handleServerMessage(data);
+      };
+
       ws.onclose = () => {
         console.log('WebSocket disconnected');
         setIsConnected(false);